@@ -330,26 +330,26 @@ class DenseGCM(torch.nn.Module):
         N = nodes.shape[1]
         overflow_mask = num_nodes + 1 > N
         # Shift node matrix into the past
-        # by one and forget the zeroth node
-        overflowing_batches = overflow_mask.nonzero().squeeze()
+        # by one and forget the zeroth node. Keep the index 1-D so
+        # the reads below are advanced-index copies, not views
+        # overlapping the slices we write to
+        overflowing_batches = overflow_mask.nonzero().reshape(-1)
         # nodes = nodes.clone()
         # adj = adj.clone()
-        # Zero entries before shifting
-        nodes[overflowing_batches, 0] = 0
-        adj[overflowing_batches, 0, :] = 0
-        adj[overflowing_batches, :, 0] = 0
-        # Roll newly zeroed zeroth entry to final entry
-        nodes[overflowing_batches] = torch.roll(nodes[overflowing_batches], -1, -2)
-        adj[overflowing_batches] = torch.roll(
-            adj[overflowing_batches], (-1, -1), (-1, -2)
-        )
+        # Shift entries up by one using slices, rather than
+        # zeroing and rolling, which copies the full matrices
+        nodes[overflowing_batches, :-1] = nodes[overflowing_batches, 1:]
+        nodes[overflowing_batches, -1] = 0
+        adj[overflowing_batches, :-1, :-1] = adj[overflowing_batches, 1:, 1:]
+        adj[overflowing_batches, -1, :] = 0
+        adj[overflowing_batches, :, -1] = 0
         if weights.numel() != 0:
             # weights = weights.clone()
-            weights[overflowing_batches, 0, :] = 0
-            weights[overflowing_batches, :, 0] = 0
-            weights[overflowing_batches] = torch.roll(
-                weights[overflowing_batches], (-1, -1), (-1, -2)
-            )
+            weights[overflowing_batches, :-1, :-1] = weights[
+                overflowing_batches, 1:, 1:
+            ]
+            weights[overflowing_batches, -1, :] = 0
+            weights[overflowing_batches, :, -1] = 0
 
         num_nodes[overflow_mask] = num_nodes[overflow_mask] - 1
         return nodes, adj, weights, num_nodes
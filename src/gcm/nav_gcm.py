@@ -1,5 +1,6 @@
 import torch
 import torch_geometric
+from gcm import util
 
 
 # TODO: We need to make this a for loop over temporal dim
@@ -38,30 +39,14 @@ class NavGCM(torch.nn.Module):
     def make_idx(self, T, taus):
         """Returns batch and time idxs marking
         all valid (non-padded) elements in the vert matrix"""
-        batch = torch.repeat_interleave(
-            torch.arange(T.shape[0], device=T.device),
-            T + taus,
-        )
-        time = torch.cat([
-            torch.arange(T[b] + taus[b], device=T.device) 
-            for b in range(T.shape[0])
-        ], dim=-1)
-        return batch, time
+        return util.get_valid_node_idxs(T, taus, T.shape[0])
 
     def make_new_idx(
         self, T, taus
     ):
         """Returns batch and time idxs marking
         all NEW elements in the vert matrix"""
-        batch = torch.repeat_interleave(
-            torch.arange(T.shape[0], device=T.device),
-            taus,
-        )
-        time = torch.cat([
-            torch.arange(T[b], T[b] + taus[b], device=T.device) 
-            for b in range(T.shape[0])
-        ], dim=-1)
-        return batch, time
+        return util.get_new_node_idxs(T, taus, T.shape[0])
 
     def make_output_idx(
         self, taus
@@ -70,15 +55,7 @@ class NavGCM(torch.nn.Module):
         time idxs marking all NEW elements. Unlike make_new_idx
         the indices correspond to locations in the padded OUTPUT
         matrix rather than the full vertex matrix"""
-        batch = torch.repeat_interleave(
-            torch.arange(taus.shape[0], device=taus.device),
-            taus,
-        )
-        time = torch.cat([
-            torch.arange(taus[b], device=taus.device)
-            for b in range(taus.shape[0])
-        ], dim=-1)
-        return batch, time
+        return util.get_nonpadded_idxs(torch.zeros_like(taus), taus, taus.shape[0])
 
     def make_flat_new_idx(
         self, T, taus
@@ -86,11 +63,10 @@ class NavGCM(torch.nn.Module):
         """Return index of all new elements, like make_new_idx.
         However, rather than [B, T] indexing, this returns [B * T]
         indicies to extract new nodes from the GNN output"""
-        cs = (T + taus).cumsum(0)
-        return torch.cat([
-            torch.arange(cs[b] - taus[b], cs[b], device=T.device)
-            for b in range(T.shape[0])
-        ], dim=-1)
+        # Offset the time idx of each new node by the
+        # number of nodes in all prior batches
+        batch, time = util.get_new_node_idxs(T, taus, T.shape[0])
+        return util.exclusive_cumsum(T + taus)[batch] + time
 
     def knn_edges(
         self, x, pos, rot
@@ -202,8 +178,6 @@ class NavGCM(torch.nn.Module):
         for each timestep, greatly increasing memory usage and reducing 
         throughput"""
         # TODO dont hardcode hidden
-        # TODO: flat_new_idx indexing is probably wrong,
-        # as the total number of nodes is different here than in the causal case
         graphs = []
         for b in range(out_batch):
             for t in range(out_time):
@@ -232,7 +206,10 @@ class NavGCM(torch.nn.Module):
             )
 
         output = self.gnn(batch.x, batch.edge_index, batch.pos, batch.rot, batch.batch)
-        return output
+        # Each graph ends at the node added at its timestep, so the
+        # new nodes are the last node of each graph. Graphs are ordered
+        # by batch then time, matching out_idx
+        return output[batch.ptr[1:] - 1]
 
     def forward(
         self,
@@ -243,7 +220,9 @@ class NavGCM(torch.nn.Module):
         state, # [old_x, old_pos, old_rots, each of size [B, T.max(), *]]
     ):
         old_x, old_pos, old_rot, T = state
-        out_batch, out_time = x.shape[0], taus.max()
+        # Inputs are already padded to the output time dim,
+        # so take it from the shape rather than syncing on taus.max()
+        out_batch, out_time = x.shape[0], x.shape[1]
         # Update hidden state
         self.compute_idx(T, taus)
         x, pos, rot = self.update(x, pos, rot, old_x, old_pos, old_rot, T, taus)
@@ -254,10 +233,10 @@ class NavGCM(torch.nn.Module):
             output_at_target = self.full_forward(x, pos, rot, T, taus, out_batch, out_time)
 
         # Compute padded output at the inputted vert idxs
-        padded_output = torch.zeros(
-            (out_batch, out_time, output.shape[-1]), device=x.device
+        padded_output = output_at_target.new_zeros(
+            (out_batch, out_time, output_at_target.shape[-1])
         )
         # Offset from 0 instead of T 
-        padded_output[self.out_idx] = output[self.flat_new_idx]
+        padded_output.index_put_(self.out_idx, output_at_target)
 
         return padded_output, state
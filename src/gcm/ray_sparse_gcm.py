@@ -44,6 +44,13 @@ class RaySparseGCM(TorchModelV2, nn.Module):
         # the forward pass. This will improve runtime if set. It should
         # be set to the number of graph layers in the GNN
         "max_hops": None,
+        # Whether to store edge weights in the recurrent state. SparseGCM
+        # sets the weight of every edge to one, so the stored weights are
+        # redundant unless the GCM is modified to produce other weights.
+        # If False, weights are omitted from the state and restored as ones
+        "edge_weights": True,
+        # Whether to compile the GNN using torch.compile (torch >= 2.2)
+        "compile_gnn": False,
         # Torch.nn.module used for determining edges between nodes.
         # You can chain multiple modules together use
         # torch_geometric.nn.Sequential
@@ -135,6 +142,7 @@ class RaySparseGCM(TorchModelV2, nn.Module):
             aux_edge_selectors=self.cfg["aux_edge_selectors"],
             positional_encoder=pe,
             max_hops=cfg["max_hops"],
+            compile_gnn=cfg["compile_gnn"],
         )
 
         self.logit_branch = SlimFC(
@@ -153,13 +161,18 @@ class RaySparseGCM(TorchModelV2, nn.Module):
 
     def get_initial_state(self):
         nodes = torch.zeros((self.cfg["graph_size"], self.input_dim))
-        # If these are type==long, they become np arrays instead of torch...
-        edges = torch.zeros((2, self.cfg["max_edges"]))
+        # Allocate as long so we do not need to cast the whole edgelist
+        # each forward
+        edges = torch.zeros((2, self.cfg["max_edges"]), dtype=torch.long)
+        T = torch.tensor(0, dtype=torch.long)
+        # Number of valid (packed) edges in edges/weights
+        num_edges = torch.tensor(0, dtype=torch.long)
+        if not self.cfg["edge_weights"]:
+            return [nodes, edges, T, num_edges]
+
         # If we set weights to one ray makes it into np array of objs...
         weights = torch.zeros((1, self.cfg["max_edges"]))
-
-        T = torch.tensor(0, dtype=torch.long)
-        state = [nodes, edges, weights, T]
+        state = [nodes, edges, weights, T, num_edges]
 
         return state
 
@@ -181,26 +194,45 @@ class RaySparseGCM(TorchModelV2, nn.Module):
         else:
             flat = input_dict["obs_flat"]
 
-        dense = add_time_dimension(flat, max_seq_len=seq_lens.max(), framework="torch")
+        # Materialize the max sequence length once, rather than passing
+        # a tensor that add_time_dimension syncs on for each shape op
+        tau_max = int(seq_lens.max())
+        dense = add_time_dimension(flat, max_seq_len=tau_max, framework="torch")
         # TODO: ppo sequencing is broken (rllib bug not ours)
         # Batch and Time
         B = dense.shape[0]
-        t = dense.shape[1]
+        t = tau_max
         # Sometimes numpy sometimes tensor...
         if type(seq_lens) == np.ndarray:
-            taus = torch.from_numpy(seq_lens).to(dense.device).long()
+            taus = torch.from_numpy(seq_lens).long()
+            if dense.is_cuda:
+                # Copy from pinned memory so the transfer does not block
+                taus = taus.pin_memory().to(dense.device, non_blocking=True)
         else:
             taus = seq_lens.long()
 
         # We cannot set non-zero values in get_initial_state
         # so do it here instead, fill -1 and 1 for edges and weights respectively
         # where T (graph timesteps) is zero
-        init_batch_idx = (state[-1] == 0).nonzero().squeeze()
-        state[1][init_batch_idx] = -1
-        state[2][init_batch_idx] = 1.0
-        nodes, adj, T = util.unpack_hidden(state, B)
-
-        T = T.long()
+        # Legacy states are [nodes, edges, weights, T] without num_edges,
+        # in which case unpack_hidden searches for the valid edges
+        num_edges = None
+        if self.cfg["edge_weights"]:
+            nodes, edges, weights, T = state[:4]
+            if len(state) > 4:
+                num_edges = state[4]
+        elif state[2].dim() > 1:
+            # Legacy state holding weights, which we do not use
+            nodes, edges, _, T = state
+            weights = None
+        else:
+            nodes, edges, T, num_edges = state
+            weights = None
+        init_batch_idx = (T == 0).nonzero().squeeze()
+        edges[init_batch_idx] = -1
+        if weights is not None:
+            weights[init_batch_idx] = 1.0
+        nodes, adj, T = util.unpack_hidden((nodes, edges, weights, T, num_edges), B)
         hidden = (nodes, adj, T)
 
         # Push thru pre-gcm layers
@@ -209,5 +241,7 @@ class RaySparseGCM(TorchModelV2, nn.Module):
         logits = self.logit_branch(out).reshape(B * t, self.num_outputs)
         self.cur_val = self.value_branch(out).reshape(B * t)
 
-        packed_state = util.pack_hidden(hidden, B, self.cfg["max_edges"])
-        return logits, list(packed_state)
+        packed_state = util.pack_hidden(
+            hidden, B, self.cfg["max_edges"], pack_weights=self.cfg["edge_weights"]
+        )
+        return logits, [s for s in packed_state if s is not None]
@@ -3,7 +3,6 @@ import functools
 from typing import List, Any, Tuple, Union
 
 from torchtyping import TensorType, patch_typeguard  # type: ignore
-from typeguard import typechecked  # type: ignore
 from gcm import util
 
 #patch_typeguard()
@@ -42,15 +41,42 @@ class LearnedEdge(torch.nn.Module):
         temp_bounds: Tuple[float, float] = (0.001, 5),
         # Whether or not to store gradients for logging
         store_grads: bool = True,
+        # Maximum number of node pairs fed to the edge network at once.
+        # Smaller chunks keep intermediate activations in cache
+        # when there are many candidate edges
+        chunk_size: int = 4096,
+        # Whether to compile the edge network using torch.compile,
+        # fusing the Linear/ReLU/LayerNorm chain. Requires torch >= 2.0
+        compile_edge_network: bool = False,
     ):
         super().__init__()
         assert model or input_size, "Must specify either input_size or model"
         self.deterministic = deterministic
         self.num_edge_samples = num_edge_samples
         self.store_grads = store_grads
+        self.chunk_size = chunk_size
         # This MUST be done here
         # if initialized in forward model does not learn...
-        self.edge_network = self.build_edge_network(input_size) if model is None else model
+        if model is None:
+            self.lin_sink, self.lin_source = self.build_input_layers(input_size)
+            self.edge_network = self.build_edge_network(input_size)
+        else:
+            # Custom models receive (i || j)
+            self.lin_sink = self.lin_source = None
+            self.edge_network = model
+        self.compile_edge_network = compile_edge_network
+        if compile_edge_network:
+            assert hasattr(torch, "compile"), (
+                "compile_edge_network requires torch >= 2.0"
+            )
+            # Compile a function that calls the network, rather than the
+            # network itself. Dynamo skips the torch.nn call frames of a
+            # bare Sequential, so compiling it directly captures nothing.
+            # The number of edges changes between calls, so the edge dim
+            # is dynamic
+            self._compiled_edge_network = torch.compile(
+                self._run_edge_network, mode="max-autotune", dynamic=True
+            )
         self.ste = util.StraightThroughEstimator()
         self.window = window
         self.log_stats = log_stats
@@ -67,13 +93,59 @@ class LearnedEdge(torch.nn.Module):
     def grad_hook(self, p_name, grad):
         self.stats[f"gnorm_{p_name}"] = grad.norm().detach().item()
 
+    def register_grad_hooks(self, m: torch.nn.Module, prefix: str = "") -> None:
+        if self.store_grads:
+            for n, p in m.named_parameters():
+                p.register_hook(functools.partial(self.grad_hook, prefix + n))
+
+    def build_input_layers(
+        self, input_size: int
+    ) -> Tuple[torch.nn.Linear, torch.nn.Linear]:
+        """Builds the first layer of the edge network, split into
+        sink and source halves. W(i || j) + b == W_i(i) + W_j(j) + b, but
+        the split form never materializes the [E, 2 * feat] concatenation.
+        """
+        lin_sink = torch.nn.Linear(input_size, input_size)
+        lin_source = torch.nn.Linear(input_size, input_size, bias=False)
+        # Initialize W as a single orthogonal matrix and split it,
+        # so the halves match the unsplit layer at init
+        w = torch.empty(input_size, 2 * input_size)
+        torch.nn.init.orthogonal_(w)
+        with torch.no_grad():
+            lin_sink.weight.copy_(w[:, :input_size])
+            lin_source.weight.copy_(w[:, input_size:])
+        for name, m in [("sink", lin_sink), ("source", lin_source)]:
+            self.register_grad_hooks(m, f"{name}.")
+        return lin_sink, lin_source
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the first layer was split hold a single
+        # [feat, 2 * feat] edge_network.0, and the remaining edge_network
+        # layers are shifted up by one. Convert them to the split layout
+        legacy = prefix + "edge_network.0.weight"
+        if self.lin_sink is not None and legacy in state_dict:
+            w = state_dict.pop(legacy)
+            feat = w.shape[0]
+            state_dict[prefix + "lin_sink.weight"] = w[:, :feat]
+            state_dict[prefix + "lin_source.weight"] = w[:, feat:]
+            state_dict[prefix + "lin_sink.bias"] = state_dict.pop(
+                prefix + "edge_network.0.bias"
+            )
+            net = prefix + "edge_network."
+            layers = {
+                k: state_dict.pop(k) for k in list(state_dict) if k.startswith(net)
+            }
+            for k, v in layers.items():
+                idx, name = k[len(net):].split(".", 1)
+                state_dict[f"{net}{int(idx) - 1}.{name}"] = v
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def build_edge_network(self, input_size: int) -> torch.nn.Sequential:
         """Builds a network to predict edges.
-        Network input: (i || j)
+        Network input: lin_sink(i) + lin_source(j)
         Network output: logits(edge(i,j))
         """
         m = torch.nn.Sequential(
-            torch.nn.Linear(2 * input_size, input_size),
             torch.nn.ReLU(),
             torch.nn.LayerNorm(input_size),
             torch.nn.Linear(input_size, input_size),
@@ -82,12 +154,13 @@ class LearnedEdge(torch.nn.Module):
             torch.nn.Linear(input_size, 1),
         )
         m.apply(self.init_weights)
-        if self.store_grads:
-            for n, p in m.named_parameters():
-                p.register_hook(functools.partial(self.grad_hook, n))
+        self.register_grad_hooks(m)
         return m
 
-    @typechecked
+    def _run_edge_network(self, network_input: torch.Tensor) -> torch.Tensor:
+        return self.edge_network(network_input)
+
+    @util.typechecked
     def forward(
         self,
         nodes: TensorType["B", "N", "feat", float],  # type: ignore # noqa: F821
@@ -101,10 +174,11 @@ class LearnedEdge(torch.nn.Module):
             return torch.sparse_coo_tensor(
                 indices=torch.zeros(3,0, dtype=torch.long, device=nodes.device),
                 values=torch.zeros(0, device=nodes.device),
-                size=(B, nodes.shape[1], nodes.shape[1])
+                size=(B, nodes.shape[1], nodes.shape[1]),
+                is_coalesced=True,
             )
                 
-        if list(self.parameters())[0].device != nodes.device:
+        if next(self.parameters()).device != nodes.device:
             self = self.to(nodes.device)
 
         # Do for all batches at once
@@ -112,41 +186,55 @@ class LearnedEdge(torch.nn.Module):
         # Construct indices denoting all edges, which we sample from
         # Note that we only want to sample incoming edges from nodes T to T + tau
         # these indices denote nodes pairs being fed to network
-        edge_idx = util.get_causal_edges(T, taus, self.window)
+        edge_idx = util.get_causal_edges(T, taus, self.window, N=nodes.shape[1])
 
         batch_idx, sink_idx, source_idx = edge_idx.unbind()
         # Feed node pairs to network
-        sink_nodes = nodes[batch_idx, sink_idx]
-        source_nodes = nodes[batch_idx, source_idx]
-        network_input = torch.cat((sink_nodes, source_nodes), dim=-1)
-        # Logits is of shape [N]
-        logits = self.edge_network(network_input).squeeze()
-        # TODO rather than sparse to dense conversion, implement
-        # a sparse gumbel softmax
-        cutoff = 1 / (1 + self.num_edge_samples)
-        gs_input = torch.sparse_coo_tensor(
-            indices=edge_idx,
-            values=logits,
-            size=(B, nodes.shape[1], nodes.shape[1])
-        )
-        self.tau_param.data.clamp_(*self.temp_bounds)
-        if not self.deterministic:
-            soft = util.sparse_gumbel_softmax(
-                gs_input, dim=2, hard=False, tau=self.tau_param
-            )
+        if self.lin_sink is None:
+            sink_nodes = nodes[batch_idx, sink_idx]
+            source_nodes = nodes[batch_idx, source_idx]
+            network_input = torch.cat((sink_nodes, source_nodes), dim=-1)
         else:
-            soft = util.sparse_tempered_softmax(
-                gs_input, dim=2, hard=False, tau=self.tau_param
+            # Each node appears in many pairs, so project each node
+            # once and gather the projections, rather than projecting
+            # every pair
+            proj_sink = self.lin_sink(nodes)
+            proj_source = self.lin_source(nodes)
+            network_input = (
+                proj_sink[batch_idx, sink_idx] + proj_source[batch_idx, source_idx]
             )
+        # Logits is of shape [E]
+        chunks = network_input.split(self.chunk_size)
+        if self.compile_edge_network:
+            edge_mlp = self._compiled_edge_network
+        else:
+            edge_mlp = self._run_edge_network
+        logits = torch.cat([edge_mlp(chunk) for chunk in chunks]).reshape(-1)
+        cutoff = 1 / (1 + self.num_edge_samples)
+        # Softmax over the incoming edges of each sink, operating
+        # directly on the flat logits. edge_idx is already sorted
+        # by (batch, sink, source), so the output is coalesced
+        segment = batch_idx * nodes.shape[1] + sink_idx
+        self.tau_param.data.clamp_(*self.temp_bounds)
+        soft = util.segment_gumbel_softmax(
+            logits,
+            segment,
+            hard=False,
+            tau=self.tau_param,
+            gumbel=not self.deterministic,
+        )
 
-        activation_mask = soft.values() > cutoff
+        activation_mask = soft > cutoff
         adj = torch.sparse_coo_tensor(
-            indices=soft.indices()[:,activation_mask],
+            indices=edge_idx[:, activation_mask],
             values=(
-                soft.values()[activation_mask] 
-                / soft.values()[activation_mask].detach()
+                soft[activation_mask]
+                / soft[activation_mask].detach()
             ),
-            size=(B, nodes.shape[1], nodes.shape[1])
+            size=(B, nodes.shape[1], nodes.shape[1]),
+            # Masking preserves the sorted, unique order of edge_idx,
+            # so let the GCM skip the sort and dedup in coalesce()
+            is_coalesced=True,
         )
 
         # CAREFUL _values() detaches from autograd graph and breaks grads
@@ -3,7 +3,6 @@ import torch_geometric
 from typing import List, Any, Tuple, Union
 
 from torchtyping import TensorType, patch_typeguard  # type: ignore
-from typeguard import typechecked  # type: ignore
 from gcm import util
 from torch_geometric.transforms.delaunay import Delaunay
 
@@ -17,7 +16,7 @@ class SpatialKNNEdge(torch.nn.Module):
         self.position_slice = position_slice
         self.causal = causal
 
-    @typechecked
+    @util.typechecked
     def forward(
         self,
         nodes: TensorType["B", "N", "feat", float],  # type: ignore # noqa: F821
@@ -70,7 +69,7 @@ class SpatialRadiusEdge(torch.nn.Module):
         self.position_slice = position_slice
         self.causal = causal
 
-    @typechecked
+    @util.typechecked
     def forward(
         self,
         nodes: TensorType["B", "N", "feat", float],  # type: ignore # noqa: F821
@@ -98,11 +97,12 @@ class SpatialRadiusEdge(torch.nn.Module):
             sink_nodes = pos[b, sink_idx]
             source_nodes = pos[b, source_idx]
             # For some reason, torch.cdist is really slow...
-            dist = ((sink_nodes - source_nodes) ** 2).sum(dim=-1).sqrt()
-            idx_idx = torch.where(dist < self.radius)
+            # Compare squared distances to avoid the sqrt
+            sq_dist = (sink_nodes - source_nodes).square().sum(dim=-1)
+            idx_idx = torch.where(sq_dist < self.radius ** 2)
             sink_edges = sink_idx[idx_idx]
             source_edges = source_idx[idx_idx]
-            batch = b * torch.ones(sink_edges.numel(), device=pos.device, dtype=torch.long)
+            batch = torch.full_like(sink_edges, b)
             edges.append(
                 torch.stack([batch, sink_edges, source_edges])
             )
@@ -122,7 +122,7 @@ class SpatialDelaunayEdge(torch.nn.Module):
         super().__init__()
         self.position_slice = position_slice
 
-    @typechecked
+    @util.typechecked
     def forward(
         self,
         nodes: TensorType["B", "N", "feat", float],  # type: ignore # noqa: F821
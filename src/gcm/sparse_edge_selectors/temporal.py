@@ -2,7 +2,6 @@ import torch
 from typing import List, Any, Tuple, Union
 
 from torchtyping import TensorType, patch_typeguard  # type: ignore
-from typeguard import typechecked  # type: ignore
 from gcm import util
 
 patch_typeguard()
@@ -15,7 +14,7 @@ class TemporalEdge(torch.nn.Module):
         super().__init__()
         self.hops = torch.tensor(hops)
 
-    @typechecked
+    @util.typechecked
     def forward(
         self,
         nodes: TensorType["B", "N", "feat", float],  # type: ignore # noqa: F821
@@ -25,7 +24,6 @@ class TemporalEdge(torch.nn.Module):
         ) -> TensorType["B", "MAX_EDGES", "MAX_EDGES", float, torch.sparse_coo]:  # type: ignore # noqa: F821
         # Connect each [t in T to T + tau] to [t - h for h in hops]
 
-        batch_starts, batch_ends = util.get_batch_offsets(T + taus)
         edge_base: Union[List, torch.Tensor] = []
 
         # Build a base of edges (x - hop for all hops)
@@ -40,13 +38,12 @@ class TemporalEdge(torch.nn.Module):
         if len(edge_base) < 1:
             # TODO don't hardcode max edges
             return torch.zeros((B, int(1e5), int(1e5)), device=nodes.device, layout=torch.sparse_coo, dtype=torch.float)
-            empty_edges = torch.empty((2, 0), device=nodes.device, dtype=torch.long)
-            empty_weights = torch.empty((0), device=nodes.device, dtype=torch.float)
-            return empty_edges, empty_weights
 
         
-        sink_edges  = edge_base.unsqueeze(-1).repeat(1, 1, len(self.hops))
-        source_edges = sink_edges - self.hops.to(nodes.device)
+        # Broadcast [B, tau, 1] against [hops], rather than
+        # materializing a repeated copy of edge_base
+        source_edges = edge_base.unsqueeze(-1) - self.hops.to(nodes.device)
+        sink_edges = edge_base.unsqueeze(-1).expand(source_edges.shape)
         batch_idx = torch.arange(B, device=nodes.device).unsqueeze(-1).unsqueeze(-1).expand(source_edges.shape)
 
         sink_edges = sink_edges.flatten()
@@ -56,7 +53,7 @@ class TemporalEdge(torch.nn.Module):
         weights = torch.ones(source_edges.shape, device=nodes.device)
 
         # Need to filter negative (invalid) indices
-        mask = (source_edges >= 0) * (sink_edges > 0)
+        mask = (source_edges >= 0) & (sink_edges > 0)
         filtered_edge_idx = edge_idx[:, mask]
         weights = weights[mask]
         adj = torch.sparse_coo_tensor(indices=filtered_edge_idx, values=weights, size=(B, int(1e5), int(1e5)), device=nodes.device)
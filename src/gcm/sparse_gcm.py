@@ -4,7 +4,6 @@ from gcm import util
 from typing import Union, Tuple, List
 
 from torchtyping import TensorType, patch_typeguard  # type: ignore
-from typeguard import typechecked
 
 #patch_typeguard()
 
@@ -40,6 +39,15 @@ class SparseGCM(torch.nn.Module):
         # to the nodes
         # Creates an ordering in the graph
         positional_encoder: torch.nn.Module = None,
+        # If every graph in the batch has identical edges, convolve
+        # all batches using a single shared edgelist. The GNN must accept
+        # batched node features of shape [B, N, feat], which is the case
+        # for torch_geometric layers using the default node_dim=-2
+        batch_shared_edges: bool = False,
+        # Whether to compile the GNN using torch.compile. This fuses
+        # the many small elementwise and gather/scatter ops in message
+        # passing. Requires torch >= 2.2
+        compile_gnn: bool = False,
     ):
         super().__init__()
 
@@ -50,6 +58,12 @@ class SparseGCM(torch.nn.Module):
         self.aux_edge_selectors = aux_edge_selectors
         self.positional_encoder = positional_encoder
         self.max_hops = max_hops
+        self.batch_shared_edges = batch_shared_edges
+        if compile_gnn:
+            assert hasattr(self.gnn, "compile"), "compile_gnn requires torch >= 2.2"
+            # Compile in place, so parameter names are unchanged
+            # Graph sizes change every step, so compile with dynamic shapes
+            self.gnn.compile(dynamic=True)
         self.ste = util.StraightThroughEstimator()
 
     def get_initial_hidden_state(self, x):
@@ -69,7 +83,7 @@ class SparseGCM(torch.nn.Module):
 
         return nodes, adj, T
 
-    @typechecked
+    @util.typechecked
     def forward(
         self,
         x: TensorType["B", "t", "feat", float],  # type: ignore # noqa: F821 #input observations
@@ -116,16 +130,24 @@ class SparseGCM(torch.nn.Module):
         nodes = nodes.clone()
         # Add new nodes to the current graph
         #assert torch.all(adj._indices()[1] < adj._indices()[2])
+        # Number of nodes in the largest graph after insertion
+        num_nodes = int((T + taus).max())
         # TODO: Wrap around instead of terminating
-        if tau_idxs.max() >= N:
+        if num_nodes > N:
             raise Exception("Overflow")
 
         nodes[B_idxs, tau_idxs] = x[dense_B_idxs, dense_tau_idxs]
 
         # We do not want to modify graph nodes in the GCM
         # Do all mutation operations on dirty_nodes,
-        # then use clean nodes in the graph state
-        dirty_nodes = nodes.clone()
+        # then use clean nodes in the graph state.
+        # The preprocessor and positional encoder may write in place,
+        # so copy if either is set. Edge selectors only read nodes
+        # Nodes past num_nodes are padding in every batch, so drop them
+        # to avoid running the selectors and preprocessor over them
+        dirty_nodes = nodes[:, :num_nodes]
+        if self.preprocessor or self.positional_encoder:
+            dirty_nodes = dirty_nodes.clone()
 
         if self.edge_selectors:
             # TODO remove coalesce when bug is fixed
@@ -162,50 +184,67 @@ class SparseGCM(torch.nn.Module):
             values=adj.values() / adj.values().detach(),
             size=adj.shape
         )
-        # Convert to GNN input format
-        flat_nodes, output_node_idxs = util.flatten_nodes(dirty_nodes, T, taus, B)
-        edges, weights, edge_batch = util.flatten_adj(adj, T, taus, B)
-        # Our adj matrix is sink -> source, but torch_geometric
-        # expects edgelist as source -> sink, so flip
-        edges = torch.flip(edges, (0,))
-        assert torch.all(edges[0] < edges[1]), "Causality violated"
-        if edges.numel() > 0:
-            edges, weights = torch_geometric.utils.coalesce(
-                edges, weights, reduce="mean"
-            )
-        if self.max_hops is None:
-            # Convolve over entire graph
-            node_feats = self.gnn(flat_nodes, edges, weights)
-            # Extract the hidden repr at the new nodes
-            # Each mx is variable in temporal dim, so return 2D tensor of [B*tau, feat]
-            mx = node_feats[output_node_idxs]
+        shared_edges = None
+        if self.batch_shared_edges and self.max_hops is None:
+            shared_edges = util.get_shared_edges(adj, T, taus)
+
+        if shared_edges is not None:
+            # Every graph in the batch is identical, so convolve using a
+            # single edgelist instead of B offset copies of it.
+            # torch_geometric propagates over node_dim=-2, so the GNN
+            # can ingest nodes of shape [B, N, feat] directly
+            edges, weights = shared_edges
+            edges = torch.flip(edges, (0,))
+            node_feats = self.gnn(dirty_nodes, edges, weights)
+            # Extract the hidden repr at the new nodes as [B*tau, feat]
+            mx = node_feats[:, int(T[0]):num_nodes].flatten(0, 1)
         else:
-            # Convolve over subgraph (more efficient) induced by the
-            # target nodes (taus)
-            # i.e. ignore nodes/edges that are not connected
-            # to the tau (input) nodes
-            (
-                subnodes,
-                subedges,
-                node_map,
-                edge_mask,
-            )  = torch_geometric.utils.k_hop_subgraph(
-                output_node_idxs, 
-                self.max_hops, 
-                edges, 
-                relabel_nodes=True,
-                num_nodes=(T + taus).sum()
+            # Convert to GNN input format
+            flat_nodes, output_node_idxs = util.flatten_nodes(dirty_nodes, T, taus, B)
+            edges, weights, edge_batch = util.flatten_adj(adj, T, taus, B)
+            # Our adj matrix is sink -> source, but torch_geometric
+            # expects edgelist as source -> sink, so flip
+            edges = torch.flip(edges, (0,))
+            assert torch.all(edges[0] < edges[1]), "Causality violated"
+            edges, [weights] = util.coalesce_edges(
+                edges, [weights], flat_nodes.shape[0], reduce="mean"
             )
-            mx = self.gnn(flat_nodes[subnodes], subedges, weights[edge_mask])[node_map]
+            if self.max_hops is None:
+                # Convolve over entire graph
+                node_feats = self.gnn(flat_nodes, edges, weights)
+                # Extract the hidden repr at the new nodes
+                # Each mx is variable in temporal dim, so return 2D tensor of [B*tau, feat]
+                mx = node_feats[output_node_idxs]
+            else:
+                # Convolve over subgraph (more efficient) induced by the
+                # target nodes (taus)
+                # i.e. ignore nodes/edges that are not connected
+                # to the tau (input) nodes
+                (
+                    subnodes,
+                    subedges,
+                    node_map,
+                    edge_mask,
+                )  = torch_geometric.utils.k_hop_subgraph(
+                    output_node_idxs,
+                    self.max_hops,
+                    edges,
+                    relabel_nodes=True,
+                    num_nodes=(T + taus).sum()
+                )
+                mx = self.gnn(flat_nodes[subnodes], subedges, weights[edge_mask])[node_map]
 
         assert torch.all(
             torch.isfinite(mx)
         ), "Got NaN in returned memory, try using tanh activation"
 
         # Input obs were dense and padded, so output should be dense and padded
-        dense_B_idxs, dense_tau_idxs = util.get_nonpadded_idxs(T, taus, B)
-        mx_dense = torch.zeros((*x.shape[:-1], mx.shape[-1]), device=x.device)
-        mx_dense[dense_B_idxs, dense_tau_idxs] = mx
+        # Scatter into a flat [B * t, feat] view using a single
+        # contiguous index rather than a 2D advanced index
+        t = x.shape[1]
+        mx_dense = torch.zeros((B * t, mx.shape[-1]), device=x.device, dtype=mx.dtype)
+        mx_dense.index_copy_(0, dense_B_idxs * t + dense_tau_idxs, mx)
+        mx_dense = mx_dense.unflatten(0, (B, t))
 
         T = T + taus
 
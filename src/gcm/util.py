@@ -1,20 +1,40 @@
+import os
+import functools
 import torch
 import numpy as np
 import torch_geometric
-from torch_scatter import scatter_max, scatter
+import typeguard  # type: ignore
+from torch_scatter import scatter_max, scatter, scatter_softmax
 #import sparsemax
-from typing import Tuple, List
+from typing import Tuple, List, Union
 
 
-class STEFunction(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, input):
-        return (input > 0).float()
+@functools.lru_cache(maxsize=64)
+def _arange(n: int, device: torch.device, dtype: torch.dtype = torch.long) -> torch.Tensor:
+    """A cached torch.arange for the index helpers. Only use this for
+    static sizes (B, max_edges). Data-dependent sizes, including node
+    counts of graphs trimmed to max(T + taus), would fill the cache
+    with stale buffers. The returned tensor is shared
+    between calls, so it must never be modified in place"""
+    # Never cache an inference tensor, it cannot be used for autograd later
+    with torch.inference_mode(False):
+        return torch.arange(n, device=device, dtype=dtype)
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        return grad_output
-        # return torch.nn.functional.hardtanh(grad_output)
+
+def _no_typecheck(f):
+    return f
+
+
+# Runtime shape and type checks add Python overhead to every forward,
+# so only enable them when GCM_TYPECHECK is set (e.g. when debugging)
+typechecked = typeguard.typechecked if os.environ.get("GCM_TYPECHECK") else _no_typecheck
+
+# Pointwise helpers are compiled with torch.compile where available,
+# so inductor can fuse them into a single kernel
+if hasattr(torch, "compile"):
+    compile_fn = torch.compile(dynamic=True)
+else:
+    compile_fn = torch.jit.script
 
 
 class StraightThroughEstimator(torch.nn.Module):
@@ -22,8 +42,20 @@ class StraightThroughEstimator(torch.nn.Module):
         super(StraightThroughEstimator, self).__init__()
 
     def forward(self, x):
-        x = STEFunction.apply(x)
-        return x
+        # Forward is the step function, backward is the identity.
+        # A plain tensor expression (rather than a custom autograd
+        # function) so it can be fused with the surrounding ops.
+        # x - x.detach() is exactly zero, so the forward is exact
+        # even when |x| is large
+        return (x > 0).to(x.dtype) + (x - x.detach())
+
+
+@compile_fn
+def _ste_threshold(y_soft: torch.Tensor, cutoff: float) -> torch.Tensor:
+    """Straight through threshold of y_soft at cutoff, compiled so
+    the compare, cast and straight-through arithmetic fuse into one kernel"""
+    y_hard = (y_soft > cutoff).to(y_soft.dtype)
+    return y_hard + (y_soft - y_soft.detach())
 
 
 class Spardmax(torch.nn.Module):
@@ -37,9 +69,7 @@ class Spardmax(torch.nn.Module):
 
     def forward(self, x):
         # Straight through.
-        y_soft = self.sm(x)
-        y_hard = (y_soft > self.cutoff).float()
-        return y_hard - y_soft.detach() + y_soft
+        return _ste_threshold(self.sm(x), self.cutoff)
 
 
 class Hardmax(torch.nn.Module):
@@ -51,9 +81,7 @@ class Hardmax(torch.nn.Module):
 
     def forward(self, x):
         # Straight through.
-        y_soft = self.sm(x)
-        y_hard = (y_soft > self.cutoff).float()
-        return y_hard - y_soft.detach() + y_soft
+        return _ste_threshold(self.sm(x), self.cutoff)
 
 def sparse_max(x: torch.sparse_coo, dim: int=-1, keepdim=True):
     vals, counts = torch.unique(x._indices(), return_counts=True)
@@ -92,42 +120,7 @@ def sparse_gumbel_softmax(
     tau: float=1, 
     hard: bool=False,
     ) -> torch.sparse_coo:
-    # TODO remove coalesce when bug is fixed
-    logits = logits.coalesce()
-    gumbels = -torch.empty_like(logits.values()).exponential_().log()
-    gumbels = (logits.values() + gumbels) / tau
-    gumbels = torch.sparse_coo_tensor(
-        indices=logits.indices(),
-        values=gumbels,
-        size=logits.shape
-    )
-    # TODO remove coalesce when bug is fixed
-    y_soft = torch.sparse.softmax(gumbels, dim=dim).coalesce()
-
-    if not hard:
-        return y_soft
-
-    index = []
-    # Want to max across dim, so exclude it during scatter
-    scat_dims = list(range(dim)) + list(range(dim+1, logits._indices().shape[0]))
-    scat_idx = y_soft._indices()[scat_dims]
-    flat_scat_idx, offsets = flatten_idx_n_dim(scat_idx)
-    maxes, argmax = scatter_max(y_soft._values(), flat_scat_idx)
-    # TODO: Sometimes argmax will give us out of bound indices 
-    # because dim_size < numel
-    # we would use the dim_size arg to scatter, but it crashes :(
-    # so instead just mask out invalid entries
-    argmax_mask = argmax < y_soft._indices().shape[-1] 
-    maxes = maxes[argmax_mask]
-    argmax = argmax[argmax_mask]
-    index = y_soft._indices()[:, argmax]
-
-    return torch.sparse_coo_tensor(
-        indices=index,
-        values=maxes,
-        size=logits.shape,
-        device=logits.device
-    )
+    return _sparse_segment_softmax(logits, dim, tau, hard, gumbel=True)
 
 def sparse_tempered_softmax(
     logits: torch.sparse_coo, 
@@ -135,34 +128,49 @@ def sparse_tempered_softmax(
     tau: float=1, 
     hard: bool=False,
     ) -> torch.sparse_coo:
+    return _sparse_segment_softmax(logits, dim, tau, hard, gumbel=False)
+
+def _sparse_segment_softmax(
+    logits: torch.sparse_coo,
+    dim: int,
+    tau: float,
+    hard: bool,
+    gumbel: bool,
+    ) -> torch.sparse_coo:
+    """Softmax over dim of a sparse tensor, treating missing entries
+    as -inf. If hard, only keep the argmax entry along dim."""
     # TODO remove coalesce when bug is fixed
     logits = logits.coalesce()
-    sm_val = logits.values() / tau
-    sm_in = torch.sparse_coo_tensor(
-        indices=logits.indices(),
-        values=sm_val,
-        size=logits.shape
+    # Want to softmax/max across dim, so exclude it from the segment
+    scat_dims = list(range(dim)) + list(range(dim+1, logits._indices().shape[0]))
+    scat_idx = logits.indices()[scat_dims]
+    # Use the known sparse shape for strides, rather than
+    # computing them from the data (a device sync)
+    flat_scat_idx = torch.zeros_like(scat_idx[0])
+    for i, d in enumerate(scat_dims):
+        flat_scat_idx = flat_scat_idx * logits.shape[d] + scat_idx[i]
+    y_soft = segment_gumbel_softmax(
+        logits.values(), flat_scat_idx, tau=tau, gumbel=gumbel
     )
-    # TODO remove coalesce when bug is fixed
-    y_soft = torch.sparse.softmax(sm_in, dim=dim).coalesce()
 
     if not hard:
-        return y_soft
+        return torch.sparse_coo_tensor(
+            indices=logits.indices(),
+            values=y_soft,
+            size=logits.shape
+        )
 
-    index = []
-    # Want to max across dim, so exclude it during scatter
-    scat_dims = list(range(dim)) + list(range(dim+1, logits._indices().shape[0]))
-    scat_idx = y_soft._indices()[scat_dims]
-    flat_scat_idx, offsets = flatten_idx_n_dim(scat_idx)
-    maxes, argmax = scatter_max(y_soft._values(), flat_scat_idx)
+    # Take the argmax indices directly, rather than building
+    # a hard one-hot tensor and searching it for nonzeros
+    maxes, argmax = scatter_max(y_soft, flat_scat_idx)
     # TODO: Sometimes argmax will give us out of bound indices 
     # because dim_size < numel
     # we would use the dim_size arg to scatter, but it crashes :(
     # so instead just mask out invalid entries
-    argmax_mask = argmax < y_soft._indices().shape[-1] 
+    argmax_mask = argmax < y_soft.numel()
     maxes = maxes[argmax_mask]
     argmax = argmax[argmax_mask]
-    index = y_soft._indices()[:, argmax]
+    index = logits.indices()[:, argmax]
 
     return torch.sparse_coo_tensor(
         indices=index,
@@ -172,23 +180,46 @@ def sparse_tempered_softmax(
     )
 
 
+def segment_gumbel_softmax(
+    logits: torch.Tensor,
+    index: torch.Tensor,
+    tau: float=1,
+    hard: bool=False,
+    gumbel: bool=True,
+    ) -> torch.Tensor:
+    """Gumbel softmax over flat logits of shape [E], where index [E]
+    assigns each logit to a segment (e.g. batch * N + sink). The softmax
+    is taken within each segment, so no sparse/dense tensor is built.
+    If gumbel is False, this is a tempered softmax."""
+    if gumbel:
+        gumbels = -torch.empty_like(logits).exponential_().log()
+        logits = logits + gumbels
+    y_soft = scatter_softmax(logits / tau, index)
+
+    if not hard:
+        return y_soft
+
+    _, argmax = scatter_max(y_soft, index)
+    # Empty segments return argmax == numel, drop them
+    argmax = argmax[argmax < y_soft.numel()]
+    y_hard = torch.zeros_like(y_soft)
+    y_hard[argmax] = 1.0
+    return y_hard + (y_soft - y_soft.detach())
+
 
-@torch.jit.script
 def get_nonpadded_idxs(T: torch.Tensor, taus: torch.Tensor, B: int):
     """Get the non-padded indices of a zero-padded
     batch of observations. In other words, get only valid elements and discard
     the meaningless zeros."""
-    dense_B_idxs = torch.cat(
-        [torch.ones(taus[b], device=T.device, dtype=torch.long) * b for b in range(B)]
-    )
+    dense_B_idxs = _arange(B, T.device).repeat_interleave(taus)
     # These must not be offset by T like get_new_node_idxs
-    dense_tau_idxs = torch.cat(
-        [torch.arange(taus[b], device=T.device) for b in range(B)]
+    batch_starts = exclusive_cumsum(taus)
+    dense_tau_idxs = (
+        torch.arange(dense_B_idxs.numel(), device=T.device) - batch_starts[dense_B_idxs]
     )
     return dense_B_idxs, dense_tau_idxs
 
 
-@torch.jit.script
 def get_new_node_idxs(T: torch.Tensor, taus: torch.Tensor, B: int):
     """Given T and tau tensors, return indices matching batches to taus.
     These tell us which elements in the node matrix we have just added
@@ -198,17 +229,15 @@ def get_new_node_idxs(T: torch.Tensor, taus: torch.Tensor, B: int):
     g_idxs = torch.where(B_idxs == 0)
     zeroth_graph_new_nodes = nodes[B_idxs[g_idxs], tau_idxs[g_idxs]]
     """
-    # TODO: batch this using b_idx and cumsum
-    B_idxs = torch.cat(
-        [torch.ones(taus[b], device=T.device, dtype=torch.long) * b for b in range(B)]
-    )
-    tau_idxs = torch.cat(
-        [torch.arange(T[b], T[b] + taus[b], device=T.device) for b in range(B)]
-    )
+    B_idxs = _arange(B, T.device).repeat_interleave(taus)
+    # Position of each new node within its batch is its global
+    # position minus the number of new nodes in prior batches
+    batch_starts = exclusive_cumsum(taus)
+    tau_offsets = torch.arange(B_idxs.numel(), device=T.device) - batch_starts[B_idxs]
+    tau_idxs = T[B_idxs] + tau_offsets
     return B_idxs, tau_idxs
 
 
-@torch.jit.script
 def get_valid_node_idxs(T: torch.Tensor, taus: torch.Tensor, B: int):
     """Given T and tau tensors, return indices matching batches to taus.
     These tell us which elements in the node matrix are valid for convolution,
@@ -218,24 +247,23 @@ def get_valid_node_idxs(T: torch.Tensor, taus: torch.Tensor, B: int):
     g_idxs = torch.where(B_idxs == 0)
     zeroth_graph_all_nodes = nodes[B_idxs[g_idxs], tau_idxs[g_idxs]]
     """
-    # TODO: batch this using b_idx and cumsum
-    B_idxs = torch.cat(
-        [
-            torch.ones(T[b] + taus[b], device=T.device, dtype=torch.long) * b
-            for b in range(B)
-        ]
-    )
-    tau_idxs = torch.cat(
-        [torch.arange(0, T[b] + taus[b], device=T.device) for b in range(B)]
-    )
+    num_nodes = T + taus
+    B_idxs = _arange(B, T.device).repeat_interleave(num_nodes)
+    batch_starts = exclusive_cumsum(num_nodes)
+    tau_idxs = torch.arange(B_idxs.numel(), device=T.device) - batch_starts[B_idxs]
     return B_idxs, tau_idxs
 
 
+def exclusive_cumsum(x: torch.Tensor) -> torch.Tensor:
+    """Cumulative sum over dim 0, excluding the current element. I.e.
+    [x0, x1, x2] -> [0, x0, x0 + x1]"""
+    return torch.nn.functional.pad(x[:-1], (1, 0)).cumsum(0)
+
+
 def get_batch_offsets(T: torch.Tensor):
     """Get edge offsets into the flattened edge tensor."""
     batch_ends = T.cumsum(dim=0)
-    batch_starts = batch_ends.roll(1)
-    batch_starts[0] = 0
+    batch_starts = batch_ends - T
 
     return batch_starts, batch_ends
 
@@ -267,19 +295,34 @@ def get_causal_edges_one_batch(t, tau, window=None):
     
     return torch.cat((batch.unsqueeze(0), edge), dim=0)
 
-def get_causal_edges(T, taus, window=None):
+def get_causal_edges(T, taus, window=None, N=None):
     """Given T and taus, select all the causal indices. In other words,
-    return all edges going from past to future (not future to past)"""
-    edge_idx = []
-    #tril_inputs = T + taus
-    B = T.numel()
-    for b in range(B):
-        edge = get_causal_edges_one_batch(T[b], taus[b], window=window)
-        batch = b * torch.ones(1, device=T.device, dtype=torch.long)
-        batch = batch.expand(edge[-1].shape[-1])
-        edge_idx.append(torch.cat((batch.unsqueeze(0), edge), dim=0))
-    edge_idx = torch.cat(edge_idx, dim=-1)
-    return edge_idx
+    return all edges going from past to future (not future to past).
+
+    This builds every batch at once using a [B, max(taus), N]
+    mask rather than looping over get_causal_edges_one_batch. Edges are
+    ordered by (batch, sink, source), matching the per-batch tril_indices.
+    If the graph size N is not given, it is computed as max(T + taus)."""
+    T, taus = T.long(), taus.long()
+    tau_max = int(taus.max())
+    N_max = int((T + taus).max()) if N is None else N
+    # Only sinks in [T, T + tau) receive edges, so index sinks
+    # relative to T to avoid a full [B, N, N] mask
+    tau_idx = torch.arange(tau_max, device=T.device)
+    sink = T.unsqueeze(-1) + tau_idx
+    source = torch.arange(N_max, device=T.device)
+    valid = (source < sink.unsqueeze(-1)) & (
+        tau_idx < taus.unsqueeze(-1)
+    ).unsqueeze(-1)
+    # Use windows to reduce size, in case the graph is too big.
+    # Remove indices outside of the window
+    if window is not None:
+        window_min_idx = (T - window).clamp(min=0)
+        valid = valid & (source >= window_min_idx[:, None, None])
+
+    batch_idx, sink_idx, source_idx = valid.nonzero(as_tuple=True)
+    sink_idx = sink[batch_idx, sink_idx]
+    return torch.stack((batch_idx, sink_idx, source_idx))
 
 
 
@@ -302,7 +345,37 @@ def flatten_adj(adj, T, taus, B):
     flat_weights = adj.values()
 
     return flat_edges, flat_weights, batch_idx
-    
+
+
+def get_shared_edges(adj, T, taus):
+    """If every batch of a torch.coo_sparse [B, MAX_NODES, MAX_NODES]
+    has the same number of nodes, edges, and weights, return the edges [2, E]
+    and weights [E] of a single batch. Otherwise, return None.
+
+    Weights that require grad are never shared, as each batch
+    must receive its own gradient."""
+    B = T.numel()
+    # TODO remove coalesce when bug is fixed
+    adj = adj.coalesce()
+    if adj.values().requires_grad or adj.values().numel() % B != 0:
+        return None
+    if not (torch.all(T == T[0]) and torch.all(taus == taus[0])):
+        return None
+
+    # Coalesced indices are sorted by batch, so if each batch has
+    # E edges, they are laid out as [B, E] blocks
+    batch_idx = adj.indices()[0].reshape(B, -1)
+    edges = adj.indices()[1:].reshape(2, B, -1)
+    weights = adj.values().reshape(B, -1)
+    if not (
+        torch.all(batch_idx == _arange(B, adj.device).unsqueeze(-1))
+        and torch.all(edges == edges[:, :1])
+        and torch.all(weights == weights[:1])
+    ):
+        return None
+
+    return edges[:, 0], weights[0]
+
 
 def unflatten_adj(edges, weights, batch_idx, T, taus, B, max_edges):
     """Unflatten edges [2,NE], weights: [NE], and batch_idx [NE]
@@ -320,8 +393,10 @@ def unflatten_adj(edges, weights, batch_idx, T, taus, B, max_edges):
 
 
 
-def pack_hidden(hidden, B, max_edges: int, edge_fill: int=-1, weight_fill: float=1.0):
-    return _pack_hidden(*hidden, B, max_edges, edge_fill, weight_fill)
+def pack_hidden(
+    hidden, B, max_edges: int, edge_fill: int=-1, weight_fill: float=1.0, pack_weights: bool=True
+):
+    return _pack_hidden(*hidden, B, max_edges, edge_fill, weight_fill, pack_weights)
 
 def _pack_hidden(
 	nodes: torch.Tensor,
@@ -331,49 +406,78 @@ def _pack_hidden(
 	max_edges: int,
 	edge_fill: int = -1,
 	weight_fill: float = 1.0,
+	pack_weights: bool = True,
 ):
-    """Converts a torch.coo_sparse adj to a ray dense edgelist."""
-    batch_idx, source_idx, sink_idx = adj._indices().unbind()
-    dense_edges = torch.empty((B, 2, max_edges), device=adj.device, dtype=torch.long).fill_(edge_fill)
-    dense_weights = torch.empty((B, 1, max_edges), device=adj.device, dtype=torch.float).fill_(weight_fill)
+    """Converts a torch.coo_sparse adj to a ray dense edgelist.
 
+    Edges for each batch are packed contiguously from index 0, and
+    the number of valid edges for each batch is returned as num_edges.
+    If pack_weights is False, the returned weights are None"""
     # TODO remove coalesce when bug is fixed
     adj = adj.coalesce()
-    # TODO can we vectorize this without a BxNE matrix?
-    for b in range(B):
-        sparse_b_idx = torch.nonzero(batch_idx == b).reshape(-1)
-        assert sparse_b_idx.shape[-1] < max_edges, (
-            f"Cannot pack {sparse_b_idx.shape[-1]} edges into {max_edges}, increase"
+    batch_idx, source_idx, sink_idx = adj.indices().unbind()
+    dense_edges = torch.empty((B, 2, max_edges), device=adj.device, dtype=torch.long).fill_(edge_fill)
+    dense_weights = None
+    if pack_weights:
+        dense_weights = torch.empty((B, 1, max_edges), device=adj.device, dtype=torch.float).fill_(weight_fill)
+    num_edges = torch.bincount(batch_idx, minlength=B)
+    # No batch can have more edges than the total, which is known
+    # without a device sync, so only check each batch if needed
+    if batch_idx.numel() >= max_edges:
+        assert num_edges.max() < max_edges, (
+            f"Cannot pack {num_edges.max()} edges into {max_edges}, increase"
             " max edges"
         )
-        dense_b_idx = torch.arange(sparse_b_idx.shape[0])
-        dense_edges[b, :, dense_b_idx] = adj.indices()[1:, sparse_b_idx]
-        dense_weights[b, 0, dense_b_idx] = adj.values()[sparse_b_idx]
 
-    return nodes, dense_edges, dense_weights, T
+    # Coalesced edges are sorted by batch, so the position of each edge
+    # within its batch is its global position minus the batch start
+    batch_starts = exclusive_cumsum(num_edges)
+    dense_idx = (
+        torch.arange(batch_idx.numel(), device=adj.device) - batch_starts[batch_idx]
+    )
+    dense_edges[batch_idx, 0, dense_idx] = source_idx
+    dense_edges[batch_idx, 1, dense_idx] = sink_idx
+    if pack_weights:
+        dense_weights[batch_idx, 0, dense_idx] = adj.values()
+
+    return nodes, dense_edges, dense_weights, T, num_edges
 
 def unpack_hidden(hidden, B):
-    return _unpack_hidden(*hidden, B) 
+    # num_edges is optional, without it we search for valid edges
+    nodes, edges, weights, T = hidden[:4]
+    num_edges = hidden[4] if len(hidden) > 4 else None
+    return _unpack_hidden(nodes, edges, weights, T, B, num_edges)
 
 def _unpack_hidden(
     nodes: torch.Tensor,
     edges: torch.Tensor,
-    weights: torch.Tensor,
+    weights: Union[torch.Tensor, None],
     T: torch.Tensor,
-    B: torch.Tensor
+    B: torch.Tensor,
+    num_edges: Union[torch.Tensor, None] = None,
 ):
-    """Convert a ray dense edgelist into a torch.coo_sparse tensor"""
+    """Convert a ray dense edgelist into a torch.coo_sparse tensor.
+    If weights is None, all edges are given a weight of one"""
     # Get indices of valid edge pairs
-    batch_idx, edge_idx = (edges[:,0] >= 0).nonzero().T.unbind()
+    if num_edges is None:
+        valid = edges[:, 0] >= 0
+    else:
+        # Valid edges are packed contiguously, so we do not need
+        # to read the edges to find them
+        edge_idx = _arange(edges.shape[-1], edges.device)
+        valid = edge_idx < num_edges.reshape(-1, 1)
+    batch_idx, edge_idx = valid.nonzero(as_tuple=True)
     # Get values of valid edge pairs
-    sources = edges[batch_idx, 0, edge_idx]
-    sinks = edges[batch_idx, 1, edge_idx]
+    # Cast only the gathered edges, in case the
+    # state was not allocated as long
+    sources = edges[batch_idx, 0, edge_idx].long()
+    sinks = edges[batch_idx, 1, edge_idx].long()
 
     adj_idx = torch.stack([batch_idx, sources, sinks])
-    weights_filtered = weights[batch_idx, 0, edge_idx]
-    #sink_idx = edges[batch_idx, 1, source_idx]
-    #adj_idx = torch.stack([batch_idx, source_idx, sink_idx])
-
+    if weights is None:
+        weights_filtered = torch.ones(batch_idx.shape[0], device=edges.device)
+    else:
+        weights_filtered = weights[batch_idx, 0, edge_idx]
 
     adj = torch.sparse_coo_tensor(
         indices=adj_idx, values=weights_filtered, size=(B, nodes.shape[1], nodes.shape[1])
@@ -383,42 +487,63 @@ def _unpack_hidden(
 
 
 
-def flatten_edges_and_weights(edges, weights, T, taus, B):
+def coalesce_edges(
+    edges: torch.Tensor,
+    values: List[torch.Tensor],
+    num_nodes: int,
+    reduce: str = "mean",
+) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    """Sort an edgelist of shape [2, E] by (source, sink) and merge
+    duplicate edges, reducing their values using reduce (sum, mean, min,
+    max). Like torch_geometric.utils.coalesce, but using only native torch
+    ops. num_nodes must be greater than every node index in edges."""
+    reduce = {"min": "amin", "max": "amax"}.get(reduce, reduce)
+    key = edges[0] * num_nodes + edges[1]
+    key, inverse = torch.unique(key, sorted=True, return_inverse=True)
+    edges = torch.stack([key // num_nodes, key % num_nodes])
+    values = [
+        torch.zeros(key.shape[0], dtype=v.dtype, device=v.device).scatter_reduce(
+            0, inverse, v, reduce=reduce, include_self=False
+        )
+        for v in values
+    ]
+    return edges, values
+
+
+def flatten_edges_and_weights(edges, weights, T, taus, B, N=None):
     """Flatten edges from [B, 2, NE] to [2, k * NE], coalescing
     and removing invalid edges (-1). In other words, prep
-    edges and weights for GNN ingestion.
+    edges and weights for GNN ingestion. Edges are offset to
+    index into the nodes produced by flatten_nodes.
 
     Returns flattened edges, weights, and corresponding
-    batch indices"""
-    batch_offsets = get_batch_offsets(T, taus)
-    edge_offsets = (
-        batch_offsets.unsqueeze(-1).unsqueeze(-1).expand(-1, 2, edges.shape[-1])
-    )
-    offset_edges = edges + edge_offsets
-    offset_edges_B_idx = torch.cat(
-        [
-            b * torch.ones(edges.shape[-1], device=edges.device, dtype=torch.long)
-            for b in range(B)
-        ]
+    batch indices. If the graph size N is given, it is used to
+    bound the flattened node count without a host sync."""
+    offset_edges_B_idx = _arange(B, edges.device).repeat_interleave(
+        edges.shape[-1]
     )
+    # Swap dims (B,2,NE) => (2,B,NE) once, and use it
+    # for both the mask and the edges
+    edges = edges.permute(1, 0, 2).contiguous()
     # Filter invalid edges (those that were < 0 originally)
-    # Swap dims (B,2,NE) => (2,B,NE)
-    mask = (offset_edges >= edge_offsets).permute(1, 0, 2)
-    stacked_mask = (mask[0] & mask[1]).unsqueeze(0).expand(2, -1, -1)
-    # Now filter edges, weights, and indices using masks
-    # Careful, mask select will automatically flatten
-    # so do it last, this squeezes from from (2,B,NE) => (2,B*NE)
-    flat_edges = edges.permute(1, 0, 2).masked_select(stacked_mask).reshape(2, -1)
-    flat_weights = weights.permute(1, 0, 2).masked_select(stacked_mask[0]).flatten()
-    flat_B_idx = offset_edges_B_idx.masked_select(stacked_mask[0].flatten())
+    mask = edges >= 0
+    # Scan the mask once, then gather edges, weights, and
+    # indices using the flat (B*NE) index of valid edges
+    idx = (mask[0] & mask[1]).reshape(-1).nonzero(as_tuple=True)[0]
+    flat_edges = edges.reshape(2, -1)[:, idx]
+    # Weights are (B,1,NE), so view as (B*NE) rather than permuting
+    flat_weights = weights.reshape(-1)[idx]
+    flat_B_idx = offset_edges_B_idx[idx]
+    # Edges index nodes within their own batch, offset them
+    # so each batch indexes its own nodes in the flat node tensor
+    flat_edges = flat_edges + exclusive_cumsum(T + taus)[flat_B_idx]
 
     # Finally, remove duplicate edges and weights
-    # but only if we have edges
-    if flat_edges.numel() > 0:
-        # Make sure idxs are removed alongside edges and weights
-        flat_edges, [flat_weights, flat_B_idx] = torch_geometric.utils.coalesce(
-            flat_edges, [flat_weights, flat_B_idx], reduce="min"
-        )
+    # Make sure idxs are removed alongside edges and weights
+    num_flat_nodes = int((T + taus).sum()) if N is None else B * N
+    flat_edges, [flat_weights, flat_B_idx] = coalesce_edges(
+        flat_edges, [flat_weights, flat_B_idx], num_flat_nodes, reduce="min"
+    )
 
     return flat_edges, flat_weights, flat_B_idx
 
@@ -427,55 +552,37 @@ def flatten_nodes(nodes: torch.Tensor, T: torch.Tensor, taus: torch.Tensor, B: i
     """Flatten nodes from [B, N, feat] to [B * N, feat] for ingestion
     by the GNN.
 
-    Returns flattened nodes and corresponding batch indices"""
-    batch_offsets, _ = get_batch_offsets(T + taus)
-    #batch_offsets, end_offset = get_edge_offsets(T + taus)
-    B_idxs, tau_idxs = get_valid_node_idxs(T, taus, B)
-    flat_nodes = nodes[B_idxs, tau_idxs]
+    Returns flattened nodes and the flat indices of the new nodes"""
+    # Mask out padding, a boolean gather is ordered B,:T+tau
+    # which concatenates all batches without a python loop
+    N_idx = torch.arange(nodes.shape[1], device=nodes.device)
+    valid_mask = N_idx < (T + taus).unsqueeze(-1)
+    flat_nodes = nodes[valid_mask]
     # Extracting belief requires batch-tau indices (newly inserted nodes)
     # return these too
-    # Flat nodes are ordered B,:T+tau (all valid nodes)
-    # We want B,T:T+tau (new nodes), which is batch_offsets:batch_offsets + tau
-    offset_starts = batch_offsets + T
-    offset_ends = offset_starts + taus
-
-    output_node_idxs = torch.cat(
-        [
-            torch.arange(
-                offset_starts[b],
-                offset_ends[b],
-                device=nodes.device,
-            )
-            for b in range(B)
-        ]
-    )
+    # We want B,T:T+tau (new nodes), so select them from the flattened mask
+    new_mask = (N_idx >= T.unsqueeze(-1))[valid_mask]
+    output_node_idxs = new_mask.nonzero(as_tuple=True)[0]
     return flat_nodes, output_node_idxs
 
 
-@torch.jit.script
 def diff_or(tensors: List[torch.Tensor]):
     """Differentiable OR operation bewteen n-tuple of tensors
     Input: List[tensors in {0,1}]
     Output: tensor in {0,1}"""
-    print("This seems to dilute gradients, dont use it")
-    res = torch.zeros_like(tensors[0])
-    for t in tensors:
-        tmp = res.clone()
-        res = tmp + t - tmp * t
-    return res
+    return diff_or2(tensors)
 
 
-@torch.jit.script
+@compile_fn
 def diff_or2(tensors: List[torch.Tensor]):
     """Differentiable OR operation bewteen n-tuple of tensors
     Input: List[tensors in {0,1}]
     Output: tensor in {0,1}"""
-    print("This seems to dilute gradients, dont use it")
-    # This nice form is actually slower than the matrix mult form
+    # NOTE: This seems to dilute gradients, dont use it
+    # Compiled, the stack, sub and prod fuse into a single kernel
     return 1 - (1 - torch.stack(tensors, dim=0)).prod(dim=0)
 
 
-@torch.jit.script
 def idxs_up_to_including_num_nodes(
     nodes: torch.Tensor, num_nodes: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -485,20 +592,17 @@ def idxs_up_to_including_num_nodes(
     sorted by (batches, num_nodes + 1) in ascending order.
 
     Useful for getting all active nodes in the graph"""
-    seq_lens = num_nodes.unsqueeze(-1)
-    N = nodes.shape[1]
-    N_idx = torch.arange(N, device=nodes.device).unsqueeze(0)
-    N_idx = N_idx.expand(seq_lens.shape[0], N_idx.shape[1])
     # include the current node
-    N_idx = torch.nonzero(N_idx <= num_nodes.unsqueeze(1))
-    assert N_idx.shape[-1] == 2
-    batch_idxs = N_idx[:, 0]
-    node_idxs = N_idx[:, 1]
+    lens = (num_nodes + 1).clamp(max=nodes.shape[1])
+    batch_idxs = _arange(lens.shape[0], nodes.device).repeat_interleave(lens)
+    node_idxs = (
+        torch.arange(batch_idxs.numel(), device=nodes.device)
+        - exclusive_cumsum(lens)[batch_idxs]
+    )
 
     return batch_idxs, node_idxs
 
 
-@torch.jit.script
 def idxs_up_to_num_nodes(
     adj: torch.Tensor, num_nodes: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -508,15 +612,13 @@ def idxs_up_to_num_nodes(
     sorted by (batches, num_nodes, 0:num_nodes) in ascending order.
 
     Useful for getting all actives adj entries in the graph"""
-    seq_lens = num_nodes.unsqueeze(-1)
-    N = adj.shape[-1]
-    N_idx = torch.arange(N, device=adj.device).unsqueeze(0)
-    N_idx = N_idx.expand(seq_lens.shape[0], N_idx.shape[1])
     # Do not include the current node
-    N_idx = torch.nonzero(N_idx < num_nodes.unsqueeze(1))
-    assert N_idx.shape[-1] == 2
-    batch_idxs = N_idx[:, 0]
-    past_idxs = N_idx[:, 1]
+    lens = num_nodes.clamp(max=adj.shape[-1])
+    batch_idxs = _arange(lens.shape[0], adj.device).repeat_interleave(lens)
+    past_idxs = (
+        torch.arange(batch_idxs.numel(), device=adj.device)
+        - exclusive_cumsum(lens)[batch_idxs]
+    )
     curr_idx = num_nodes[batch_idxs]
 
     return batch_idxs, past_idxs, curr_idx
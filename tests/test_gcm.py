@@ -6,6 +6,7 @@ import torchviz
 
 from gcm.gcm import DenseGCM, DenseToSparse, SparseToDense, PositionalEncoding
 from gcm.edge_selectors.temporal import TemporalBackedge
+from gcm.edge_selectors.self_edge import TemporalBackedge as BidirectionalBackedge
 from gcm.edge_selectors.distance import EuclideanEdge, CosineEdge, SpatialEdge
 from gcm.edge_selectors.dense import DenseEdge
 from gcm.edge_selectors.learned import LearnedEdge
@@ -183,6 +184,27 @@ class TestWrapOverflow(unittest.TestCase):
         if not torch.all(nodes[1, -1] == desired_nodes[1, -1]):
             self.fail(f"{nodes[0]} != {desired_nodes[0]}")
 
+    def test_wrap_overflow_single_batch(self):
+        N = 4
+        feats = 5
+        s = DenseGCM(self.g, graph_size=N)
+        nodes = torch.zeros(1, N, feats)
+        adj = torch.zeros(1, N, N)
+        weights = torch.ones(1, N, N)
+        num_nodes = torch.tensor([0])
+        for t in range(N + 2):
+            obs = torch.full((1, feats), float(t))
+            _, (nodes, adj, weights, num_nodes) = s(
+                obs, (nodes, adj, weights, num_nodes)
+            )
+
+        desired_nodes = torch.arange(2, N + 2, dtype=torch.float)
+        if not torch.all(nodes[0, :, 0] == desired_nodes):
+            self.fail(f"{nodes[0, :, 0]} != {desired_nodes}")
+
+        if not torch.all(num_nodes == N):
+            self.fail(f"{num_nodes} != {N}")
+
 
 class TestGCMDirection(unittest.TestCase):
     def setUp(self):
@@ -592,6 +614,26 @@ class TestTemporalEdge(unittest.TestCase):
         if torch.any(tgt_adj != adj):
             self.fail(f"{tgt_adj} != {adj}")
 
+    def test_bidirectional_backedge(self):
+        self.s = DenseGCM(self.g, edge_selectors=BidirectionalBackedge())
+        (nodes, adj, weights, num_nodes) = (
+            self.nodes,
+            self.adj,
+            self.weights,
+            self.num_nodes,
+        )
+        for i in range(3):
+            _, (nodes, adj, weights, num_nodes) = self.s(
+                self.obs, (nodes, adj, weights, num_nodes)
+            )
+        tgt_adj = torch.zeros_like(adj)
+        tgt_adj[:, 1, 0] = 1
+        tgt_adj[:, 0, 1] = 1
+        tgt_adj[:, 2, 1] = 1
+        tgt_adj[:, 1, 2] = 1
+        if torch.any(tgt_adj != adj):
+            self.fail(f"{tgt_adj} != {adj}")
+
     def test_far_hops(self):
         (nodes, adj, weights, num_nodes) = (
             self.nodes,
@@ -10,6 +10,10 @@ class IdentGNN(torch.nn.Module):
     def forward(self, x, edges, rot, pos, batch, front_ptr, back_ptr, flat_new_idx):
         return x
 
+class FullIdentGNN(torch.nn.Module):
+    def forward(self, x, edges, pos, rot, batch):
+        return x
+
 class GNN(torch.nn.Module):
     def __init__(self, size):
         super().__init__()
@@ -169,6 +173,30 @@ class TestUpdate(unittest.TestCase):
         self.assertTrue(torch.all(tgt_pos == new_pos))
         self.assertTrue(torch.all(tgt_rot == new_rot))
 
+class TestFullForward(unittest.TestCase):
+    def setUp(self):
+        self.gcm = NavGCM(gnn=FullIdentGNN(), causal=False, r=3)
+
+    def test_ragged(self):
+        taus = torch.tensor([2, 3], dtype=torch.long)
+        T = torch.tensor([1, 0], dtype=torch.long)
+        x_in = torch.arange(2 * 3 * 1).reshape(2, 3, 1).float() + 1
+        pos_in = torch.zeros((2, 3, 2))
+        rot_in = torch.zeros((2, 3, 1))
+        state = [
+            torch.zeros(2, 10, 1),
+            torch.zeros(2, 10, 2),
+            torch.zeros(2, 10, 1),
+            T,
+        ]
+
+        output, state = self.gcm(x_in, pos_in, rot_in, taus, state)
+        # The identity GNN returns each new node at its own timestep
+        tgt = x_in.clone()
+        tgt[0, 2] = 0
+        if not torch.all(output == tgt):
+            self.fail(f"{output} != {tgt}")
+
 class TestE2E(unittest.TestCase):
     def setUp(self):
         self.gcm = NavGCM(gnn=GNN(4), causal=True, max_verts=8, r=3, edge_method="radius")
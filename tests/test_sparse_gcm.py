@@ -1,4 +1,7 @@
+import copy
 import unittest
+import unittest.mock
+import numpy as np
 import torch
 import torch_geometric
 from collections import OrderedDict
@@ -279,6 +282,57 @@ class TestPack(unittest.TestCase):
                     "{initial_packed_hidden[i]) != {repacked_hidden[i]}"
                 )
 
+    def test_pack_num_edges(self):
+        nodes = torch.zeros(self.B, self.graph_size, self.F)
+
+        dense_edge = torch.empty(self.B, 2, self.max_edges, dtype=torch.long).fill_(-1)
+        dense_edge[0, :, 0] = torch.tensor([0, 1])
+        dense_edge[1, :, 0] = torch.tensor([0, 1])
+        dense_edge[1, :, 1] = torch.tensor([1, 2])
+        dense_weight = torch.empty(self.B, 1, self.max_edges).fill_(1.0)
+
+        packed_hidden = (nodes, dense_edge, dense_weight, self.T)
+        unpacked_hidden = util.unpack_hidden(packed_hidden, self.B)
+        repacked_hidden = util.pack_hidden(unpacked_hidden, self.B, self.max_edges)
+        desired = torch.tensor([1, 2, 0])
+        if not torch.all(repacked_hidden[4] == desired):
+            self.fail(f"{repacked_hidden[4]} != {desired}")
+
+        # Entries past num_edges should be ignored when unpacking
+        garbage_edge = repacked_hidden[1].clone()
+        garbage_edge[2, :, 0] = torch.tensor([0, 1])
+        garbage_hidden = (*repacked_hidden[:1], garbage_edge, *repacked_hidden[2:])
+        unpacked = util.unpack_hidden(garbage_hidden, self.B)
+        if not torch.all(
+            unpacked[1].coalesce().indices() == unpacked_hidden[1].coalesce().indices()
+        ):
+            self.fail(f"{unpacked[1]} != {unpacked_hidden[1]}")
+
+    def test_pack_no_weights(self):
+        nodes = torch.zeros(self.B, self.graph_size, self.F)
+
+        dense_edge = torch.empty(self.B, 2, self.max_edges, dtype=torch.long).fill_(-1)
+        dense_edge[0, :, 0] = torch.tensor([0, 1])
+        dense_edge[1, :, 0] = torch.tensor([1, 2])
+        dense_weight = torch.empty(self.B, 1, self.max_edges).fill_(1.0)
+
+        packed_hidden = (nodes, dense_edge, dense_weight, self.T)
+        desired = util.unpack_hidden(packed_hidden, self.B)[1].coalesce()
+        packed_hidden = (nodes, dense_edge, None, self.T)
+        unpacked = util.unpack_hidden(packed_hidden, self.B)[1].coalesce()
+        if not torch.all(unpacked.indices() == desired.indices()):
+            self.fail(f"{unpacked} != {desired}")
+        if not torch.all(unpacked.values() == desired.values()):
+            self.fail(f"{unpacked} != {desired}")
+
+        repacked_hidden = util.pack_hidden(
+            (nodes, unpacked, self.T), self.B, self.max_edges, pack_weights=False
+        )
+        if repacked_hidden[2] is not None:
+            self.fail(f"{repacked_hidden[2]} is not None")
+        if not torch.all(repacked_hidden[1] == dense_edge):
+            self.fail(f"{repacked_hidden[1]} != {dense_edge}")
+
     def test_unpack_empty(self):
         nodes = torch.zeros(self.B, self.graph_size, self.F)
 
@@ -429,6 +483,38 @@ class TestDenseVsSparse(unittest.TestCase):
             self.fail(f"{dense_outs} != {sparse_outs}")
 
 
+    def test_temporal_edges_shared(self):
+        self.sparse_gcm = SparseGCM(
+            self.sparse_g, edge_selectors=TemporalEdge([1, 2]), graph_size=8
+        )
+        self.shared_gcm = SparseGCM(
+            self.sparse_g,
+            edge_selectors=TemporalEdge([1, 2]),
+            graph_size=8,
+            batch_shared_edges=True,
+        )
+        F = self.F
+        B = 3
+        ts = 8
+        self.obs = torch.arange(B * ts * F, dtype=torch.float32).reshape(B, ts, F)
+
+        sparse_hidden = None
+        shared_hidden = None
+        taus = torch.ones(B, dtype=torch.long) * 4
+        for i in range(2):
+            obs = self.obs[:, 4 * i : 4 * (i + 1)]
+            sparse_out, sparse_hidden = self.sparse_gcm(obs, taus, sparse_hidden)
+            shared_out, shared_hidden = self.shared_gcm(obs, taus, shared_hidden)
+
+            if not torch.allclose(sparse_out, shared_out):
+                self.fail(f"{sparse_out} != {shared_out}")
+
+        if not torch.all(
+            sparse_hidden[1].coalesce().indices()
+            == shared_hidden[1].coalesce().indices()
+        ):
+            self.fail(f"{sparse_hidden[1]} != {shared_hidden[1]}")
+
     def test_temporal_edges_2_hop(self):
         self.dense_gcm = DenseGCM(
             self.dense_g, edge_selectors=TemporalBackedge([1, 2]), graph_size=8
@@ -769,6 +855,57 @@ class TestLearnedEdge(unittest.TestCase):
         adj.coalesce().values().sum().backward()
         self.assertTrue(canary.grad is not None)
 
+    def test_input_layers_orthogonal(self):
+        sel = SLearnedEdge(input_size=self.F)
+        w = torch.cat((sel.lin_sink.weight, sel.lin_source.weight), dim=-1)
+        eye = torch.eye(self.F)
+        if not torch.allclose(w @ w.T, eye, atol=1e-5):
+            self.fail(f"{w @ w.T} != {eye}")
+
+    def test_load_legacy_state_dict(self):
+        sel = SLearnedEdge(input_size=self.F)
+        # Layout from before the first layer was split
+        legacy = {
+            "tau_param": sel.tau_param.detach().clone(),
+            "edge_network.0.weight": torch.cat(
+                (sel.lin_sink.weight, sel.lin_source.weight), dim=-1
+            ).detach(),
+            "edge_network.0.bias": sel.lin_sink.bias.detach().clone(),
+        }
+        for k, v in sel.edge_network.state_dict().items():
+            idx, name = k.split(".", 1)
+            legacy[f"edge_network.{int(idx) + 1}.{name}"] = v.clone()
+
+        loaded = SLearnedEdge(input_size=self.F)
+        loaded.load_state_dict(legacy)
+        for k, v in sel.state_dict().items():
+            if not torch.equal(v, loaded.state_dict()[k]):
+                self.fail(f"{k}: {v} != {loaded.state_dict()[k]}")
+
+    @unittest.skipUnless(hasattr(torch, "compile"), "requires torch.compile")
+    def test_compile_edge_network(self):
+        from torch._dynamo.utils import counters
+
+        torch._dynamo.reset()
+        counters.clear()
+        torch.manual_seed(0)
+        B = 2
+        gsize = 4
+        taus = gsize * torch.ones(B, dtype=torch.long)
+        T = torch.zeros(B, dtype=torch.long)
+        obs = torch.rand(B, gsize, self.F)
+        sel = SLearnedEdge(
+            input_size=self.F, deterministic=True, compile_edge_network=True
+        )
+        adj = sel(obs, T, taus, B)
+        self.assertGreater(counters["stats"]["unique_graphs"], 0)
+
+        eager = SLearnedEdge(input_size=self.F, deterministic=True)
+        eager.load_state_dict(sel.state_dict())
+        desired = eager(obs, T, taus, B)
+        if not torch.equal(adj._indices(), desired._indices()):
+            self.fail(f"{adj._indices()} != {desired._indices()}")
+
 
 
 class TestUtil(unittest.TestCase):
@@ -791,6 +928,132 @@ class TestUtil(unittest.TestCase):
         if flat.unique().shape != flat.shape:
             self.fail(f"Repeated elems {flat}")
 
+    def test_flatten_nodes(self):
+        B, N, F = 3, 5, 2
+        nodes = torch.arange(B * N * F, dtype=torch.float).reshape(B, N, F)
+        T = torch.tensor([1, 0, 3])
+        taus = torch.tensor([2, 1, 2])
+        flat_nodes, output_node_idxs = util.flatten_nodes(nodes, T, taus, B)
+        desired_nodes = torch.cat([nodes[0, :3], nodes[1, :1], nodes[2, :5]])
+        desired_idxs = torch.tensor([1, 2, 3, 7, 8])
+        if torch.any(flat_nodes != desired_nodes):
+            self.fail(f"{flat_nodes} != {desired_nodes}")
+        if torch.any(output_node_idxs != desired_idxs):
+            self.fail(f"{output_node_idxs} != {desired_idxs}")
+
+    def test_node_idxs(self):
+        T = torch.tensor([2, 0, 3])
+        taus = torch.tensor([1, 3, 0])
+        B = T.numel()
+        for fn, sizes, offsets in [
+            (util.get_nonpadded_idxs, taus, torch.zeros_like(T)),
+            (util.get_new_node_idxs, taus, T),
+            (util.get_valid_node_idxs, T + taus, torch.zeros_like(T)),
+        ]:
+            B_idxs, tau_idxs = fn(T, taus, B)
+            desired_B = torch.cat([torch.full((int(sizes[b]),), b) for b in range(B)])
+            desired_tau = torch.cat(
+                [torch.arange(int(sizes[b])) + offsets[b] for b in range(B)]
+            )
+            if torch.any(B_idxs != desired_B):
+                self.fail(f"{fn}: {B_idxs} != {desired_B}")
+            if torch.any(tau_idxs != desired_tau):
+                self.fail(f"{fn}: {tau_idxs} != {desired_tau}")
+
+    def test_ste(self):
+        x = torch.tensor([-1.0, 0.0, 2.0], requires_grad=True)
+        y = util.StraightThroughEstimator()(x)
+        y.sum().backward()
+        desired = torch.tensor([0.0, 0.0, 1.0])
+        if torch.any(y != desired):
+            self.fail(f"{y} != {desired}")
+        if torch.any(x.grad != 1.0):
+            self.fail(f"{x.grad} != 1.0")
+
+    def test_ste_large_input(self):
+        x = torch.tensor([-3e7, 3e7], requires_grad=True)
+        y = util.StraightThroughEstimator()(x)
+        y.sum().backward()
+        desired = torch.tensor([0.0, 1.0])
+        if torch.any(y != desired):
+            self.fail(f"{y} != {desired}")
+        if torch.any(x.grad != 1.0):
+            self.fail(f"{x.grad} != 1.0")
+
+    def test_flatten_edges_and_weights(self):
+        edges = torch.tensor([
+            [[0, 1, -1], [1, 2, -1]],
+            [[0, -1, -1], [2, -1, -1]],
+        ])
+        weights = torch.tensor([[[0.1, 0.2, 0.3]], [[0.4, 0.5, 0.6]]])
+        T = torch.tensor([3, 3])
+        taus = torch.tensor([1, 1])
+        flat_edges, flat_weights, flat_B_idx = util.flatten_edges_and_weights(
+            edges, weights, T, taus, 2
+        )
+        # Batch 1 nodes start after the 4 nodes of batch 0
+        desired_edges = torch.tensor([[0, 1, 4], [1, 2, 6]])
+        desired_weights = torch.tensor([0.1, 0.2, 0.4])
+        desired_B_idx = torch.tensor([0, 0, 1])
+        if torch.any(flat_edges != desired_edges):
+            self.fail(f"{flat_edges} != {desired_edges}")
+        if torch.any(flat_weights != desired_weights):
+            self.fail(f"{flat_weights} != {desired_weights}")
+        if torch.any(flat_B_idx != desired_B_idx):
+            self.fail(f"{flat_B_idx} != {desired_B_idx}")
+
+    def test_flatten_edges_and_weights_shared_edge(self):
+        # Both batches contain the local edge (0, 1)
+        edges = torch.tensor([
+            [[0, -1], [1, -1]],
+            [[0, 1], [1, 2]],
+        ])
+        weights = torch.tensor([[[0.1, 0.2]], [[0.3, 0.4]]])
+        T = torch.tensor([1, 2])
+        taus = torch.tensor([1, 1])
+        desired_edges = torch.tensor([[0, 2, 3], [1, 3, 4]])
+        desired_weights = torch.tensor([0.1, 0.3, 0.4])
+        desired_B_idx = torch.tensor([0, 1, 1])
+        for N in [None, 3]:
+            flat_edges, flat_weights, flat_B_idx = util.flatten_edges_and_weights(
+                edges, weights, T, taus, 2, N=N
+            )
+            if torch.any(flat_edges != desired_edges):
+                self.fail(f"{flat_edges} != {desired_edges}")
+            if torch.any(flat_weights != desired_weights):
+                self.fail(f"{flat_weights} != {desired_weights}")
+            if torch.any(flat_B_idx != desired_B_idx):
+                self.fail(f"{flat_B_idx} != {desired_B_idx}")
+
+    def test_coalesce_edges(self):
+        edges = torch.tensor([[2, 0, 2, 1, 0], [3, 1, 3, 0, 1]])
+        weights = torch.tensor([1.0, 2.0, 3.0, 4.0, 6.0])
+        for reduce in ["mean", "min", "sum"]:
+            desired_edges, desired_weights = torch_geometric.utils.coalesce(
+                edges, weights, reduce=reduce
+            )
+            actual_edges, [actual_weights] = util.coalesce_edges(
+                edges, [weights], 4, reduce=reduce
+            )
+            if torch.any(actual_edges != desired_edges):
+                self.fail(f"{reduce}: {actual_edges} != {desired_edges}")
+            if torch.any(actual_weights != desired_weights):
+                self.fail(f"{reduce}: {actual_weights} != {desired_weights}")
+
+    def test_causal_edges(self):
+        T = torch.tensor([0, 3, 5, 2])
+        taus = torch.tensor([4, 2, 0, 1])
+        for window in [None, 1, 3]:
+            edges = util.get_causal_edges(T, taus, window=window)
+            desired = []
+            for b in range(T.numel()):
+                edge = util.get_causal_edges_one_batch(T[b], taus[b], window=window)
+                batch = b * torch.ones(edge.shape[-1], dtype=torch.long)
+                desired.append(torch.cat((batch.unsqueeze(0), edge), dim=0))
+            desired = torch.cat(desired, dim=-1)
+            if edges.shape != desired.shape or torch.any(edges != desired):
+                self.fail(f"window {window}: {edges} != {desired}")
+
     def test_sparse_gumbel_softmax(self):
         idx = torch.tensor([
             [0, 0, 0, 0, 0, 0, 1, 1],
@@ -818,6 +1081,17 @@ class TestUtil(unittest.TestCase):
         if torch.any(res.coalesce().values() != desired.coalesce().values()):
             self.fail(f"{res} != {desired}")
 
+    def test_segment_gumbel_softmax(self):
+        index = torch.tensor([0, 0, 0, 2, 2, 3])
+        values = torch.ones(6) * 1e15
+        values[1] = 0
+        values[2] = 0
+        values[4] = 0
+        res = util.segment_gumbel_softmax(values, index, hard=True)
+        desired = torch.tensor([1.0, 0, 0, 1, 0, 1])
+        if torch.any(res != desired):
+            self.fail(f"{res} != {desired}")
+
 
 class TestE2E(unittest.TestCase):
     def test_e2e_learned_edge(self):
@@ -885,6 +1159,64 @@ class TestE2E(unittest.TestCase):
         out.mean().backward()
         self.assertTrue(canary.grad is not None)
 
+    def test_inplace_preprocessor(self):
+        F = 4
+        B = 2
+        sparse_g = torch_geometric.nn.Sequential(
+            "x, edges, weights",
+            [
+                (torch_geometric.nn.GraphConv(F, F), "x, edges, weights -> x"),
+            ],
+        )
+        sparse_gcm = SparseGCM(
+            sparse_g,
+            graph_size=8,
+            edge_selectors=TemporalEdge([1]),
+            preprocessor=torch.nn.ReLU(inplace=True),
+        )
+        obs = -torch.ones(B, 3, F)
+        taus = 3 * torch.ones(B, dtype=torch.long)
+        out, (nodes, adj, T) = sparse_gcm(obs, taus, None)
+        # The stored observations must not be modified by the preprocessor
+        if not torch.all(nodes[:, :3] == obs):
+            self.fail(f"{nodes[:, :3]} != {obs}")
+
+    @unittest.skipUnless(
+        hasattr(torch.nn.Module, "compile"), "requires torch.nn.Module.compile"
+    )
+    def test_compile_gnn(self):
+        from torch._dynamo.utils import counters
+
+        torch._dynamo.reset()
+        counters.clear()
+        torch.manual_seed(0)
+        F = 4
+        B = 2
+        sparse_g = torch_geometric.nn.Sequential(
+            "x, edges, weights",
+            [
+                (torch_geometric.nn.GraphConv(F, F), "x, edges, weights -> x"),
+                (torch.nn.Tanh()),
+            ],
+        )
+        eager_gcm = SparseGCM(
+            copy.deepcopy(sparse_g), graph_size=8, edge_selectors=TemporalEdge([1])
+        )
+        compiled_gcm = SparseGCM(
+            sparse_g,
+            graph_size=8,
+            edge_selectors=TemporalEdge([1]),
+            compile_gnn=True,
+        )
+        obs = torch.rand(B, 3, F)
+        taus = 3 * torch.ones(B, dtype=torch.long)
+        out, hidden = compiled_gcm(obs, taus, None)
+        self.assertGreater(counters["stats"]["unique_graphs"], 0)
+
+        desired, _ = eager_gcm(obs, taus, None)
+        if not torch.allclose(out, desired, atol=1e-5):
+            self.fail(f"{out} != {desired}")
+
     def test_ray_sparse_edge_grad(self):
         B = 1
         F = 64
@@ -956,6 +1288,42 @@ class TestE2E(unittest.TestCase):
         self.assertTrue(output.requires_grad)
         self.assertTrue(canary.grad is not None)
 
+    def test_ray_sparse_legacy_state(self):
+        B = 2
+        F = 64
+        num_obs = 4
+        graph_size = 32
+        act_space = gym.spaces.Discrete(1)
+        obs_space = gym.spaces.Box(high=1000, low=-1000, shape=(F,))
+
+        def add_time_dimension(flat, max_seq_len, framework):
+            return flat.reshape(-1, max_seq_len, flat.shape[-1])
+
+        for edge_weights in [True, False]:
+            ray_gcm = ray_sparse_gcm.RaySparseGCM(
+                obs_space,
+                act_space,
+                1,
+                {},
+                'my_model',
+                edge_weights=edge_weights,
+            )
+            input_dict = {"obs_flat": torch.ones(B * num_obs, F)}
+            # [nodes, edges, weights, T] without num_edges
+            state = [
+                torch.zeros(B, graph_size, F),
+                torch.zeros(B, 2, 50).long(),
+                torch.zeros(B, 1, 50),
+                torch.zeros(B).long(),
+            ]
+            seq_lens = num_obs * np.ones(B, dtype=np.int32)
+            with unittest.mock.patch.object(
+                ray_sparse_gcm, "add_time_dimension", add_time_dimension
+            ):
+                output, hidden = ray_gcm.forward(input_dict, state, seq_lens)
+            self.assertEqual(output.shape, (B * num_obs, 1))
+            self.assertEqual(len(hidden), 5 if edge_weights else 4)
+
 
 if __name__ == "__main__":
     unittest.main()